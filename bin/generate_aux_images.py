@@ -155,12 +155,16 @@ if __name__ == '__main__':
 
     fs = Filestore(root_path)
 
+    # Put the path map in the object store once, instead of serializing it
+    # again for every task
+    aux_path_map_ref = ray.put(aux_path_map)
+
     total_count = 0
     try:
         unfinished = []
         for zarr_path in yield_ome_zarrs(fs):
             unfinished.append(process_zarr.remote(zarr_path, root_path, aux_root_path, \
-                aux_path_map, args.aux_image_name, thumbnail_size, args.apply_brightness_correction))
+                aux_path_map_ref, args.aux_image_name, thumbnail_size, args.apply_brightness_correction))
         while unfinished:
             finished, unfinished = ray.wait(unfinished, num_returns=1)
             for result in ray.get(finished):
@@ -13,7 +13,6 @@ import re
 import unicodedata
 import argparse
 import pandas as pd
-from functools import partial
 from loguru import logger
 from sqlalchemy import Column, String, Table
 
@@ -22,6 +21,19 @@ from zarrcade.settings import get_settings
 
 SKIP_FILE_CHECKS = True
 
+# Number of metadata rows to read and load at a time
+METADATA_CHUNK_SIZE = 50_000
+
+# Compiled once, since slugify is called for every metadata column
+SLUG_NONWORD = re.compile(r"[^\w\s-]")
+SLUG_DASHES = re.compile(r"[-\s]+")
+
+# Lowercases ASCII and drops the same characters as SLUG_NONWORD, in one pass
+SLUG_ASCII_TABLE = {
+    c: (chr(c).lower() if chr(c).isalnum() or chr(c) in "_-" or chr(c).isspace() else None)
+    for c in range(128)
+}
+
 parser = argparse.ArgumentParser(
     description=__doc__,
     formatter_class=argparse.ArgumentDefaultsHelpFormatter
@@ -55,15 +67,37 @@ fs = Filestore(data_url)
 
 # Connect to the database
 logger.info(f"Database URL is {db_url}")
-db = Database(db_url)
+db = Database(db_url, sqlite_wal=settings.sqlite_wal)
 engine = db.engine
 meta = db.meta
 
-# Read the metadata
+def read_csv_chunks(path, column_names):
+    """ Yields consecutive chunks of the given CSV file as DataFrames.
+        When pyarrow is available, the file is streamed with its CSV reader 
+        and the values are kept in Arrow-backed string columns, instead of
+        one Python object per cell.
+    """
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+    except ImportError:
+        yield from pd.read_csv(path, chunksize=METADATA_CHUNK_SIZE)
+        return
+
+    # Every metadata column is stored as a string, so don't let type
+    # inference on the first block decide otherwise for later blocks
+    reader = pa_csv.open_csv(path,
+        convert_options=pa_csv.ConvertOptions(
+            column_types={c: pa.string() for c in column_names},
+            strings_can_be_null=True))
+    for batch in reader:
+        yield batch.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+# Read the metadata header. The rows are streamed in chunks when loading.
 logger.info(f"Reading {metadata_path}")
-df = pd.read_csv(metadata_path)
-path_column_name = df.columns[0]
-logger.info(f"Parsed {df.shape[0]} rows from metadata CSV")
+csv_columns = pd.read_csv(metadata_path, nrows=0).columns
+path_column_name = csv_columns[0]
 logger.info(f"The first column '{path_column_name}' will be treated as the relative path")
 
 # Adapted from https://github.com/django/django/blob/main/django/utils/text.py
@@ -75,22 +109,29 @@ def slugify(value, allow_unicode=False):
     trailing whitespace, dashes, and underscores.
     """
     value = str(value)
-    if allow_unicode:
-        value = unicodedata.normalize("NFKC", value)
+    if value.isascii():
+        # ASCII is already in every normalization form
+        pass
+    elif allow_unicode:
+        if not unicodedata.is_normalized("NFKC", value):
+            value = unicodedata.normalize("NFKC", value)
     else:
         value = (
             unicodedata.normalize("NFKD", value)
             .encode("ascii", "ignore")
             .decode("ascii")
         )
-    value = re.sub(r"[^\w\s-]", "", value.lower())
-    return 'c_'+re.sub(r"[-\s]+", "_", value).strip("-_")
+    if value.isascii():
+        value = value.translate(SLUG_ASCII_TABLE)
+    else:
+        value = SLUG_NONWORD.sub("", value.lower())
+    return 'c_'+SLUG_DASHES.sub("_", value).strip("-_")
 
 col2slug = {}
 db_names = []
 original_names = []
 # Skip the first column which is the zarr_path
-columns = df.columns[1:]
+columns = csv_columns[1:]
 # Slugify the column names
 for original_name in columns:
     db_name = slugify(original_name)
@@ -121,13 +162,6 @@ elif not overwrite:
 # Save metadata to the database
 if overwrite or 'metadata' not in meta.tables:
 
-    # Process metadata into table format
-    def rename_logic(x, idx):
-        return x if idx == 0 else col2slug[x]
-    df.columns = [rename_logic(x, i) for i, x in enumerate(df.columns)]
-    df.rename(columns={path_column_name: 'zarr_path'}, inplace=True)
-    df.insert(0, 'collection', fs.fsroot)
-
     if 'metadata' in meta.tables:
         logger.info("Dropping existing metadata table")
         meta.tables.get('metadata').drop(engine)
@@ -139,31 +173,53 @@ if overwrite or 'metadata' not in meta.tables:
     for colname in col2slug.values():
         table_columns.append(Column(colname, String))
         
-    def get_aux_path(filename, zarr_path):
-        zarr_name, _ = os.path.splitext(zarr_path)
-        aux_path = os.path.join(args.aux_path, zarr_name, filename)
+    # List the auxiliary store once, rather than checking each file separately
+    existing_aux_paths = set()
+    if not SKIP_FILE_CHECKS:
+        existing_aux_paths = set(fs.find(args.aux_path))
+        logger.info(f"Found {len(existing_aux_paths)} auxiliary files")
+
+    aux_path_prefix = os.path.join(args.aux_path, '')
+
+    def get_aux_paths(zarr_names, filename):
+        """ Returns the auxiliary file paths for a series of zarr names 
+            (i.e. zarr paths without their extension).
+        """
+        aux_paths = aux_path_prefix + zarr_names + '/' + filename
         if SKIP_FILE_CHECKS:
-            return aux_path
-        elif fs.exists(aux_path):
-            logger.trace(f"Found auxiliary file: {fs.fsroot}/{aux_path}")
-            return aux_path
-        else:
-            logger.trace(f"Missing auxiliary file: {fs.fsroot}/{aux_path}")
-            return None
-
-    if args.aux_image_name:
-        df['aux_image_path'] = df['zarr_path'].apply(partial(get_aux_path, args.aux_image_name))
-
-    if args.thumbnail_name:
-        df['thumbnail_path'] = df['zarr_path'].apply(partial(get_aux_path, args.thumbnail_name))
+            return aux_paths
+        found = aux_paths.isin(existing_aux_paths)
+        logger.trace(f"Found {found.sum()} of {len(aux_paths)} {filename} auxiliary files")
+        return aux_paths.where(found, None)
 
     metadata_table = Table('metadata', meta, *table_columns, extend_existing=True)
     meta.create_all(engine)
     logger.info(f"Created empty metadata table with {len(table_columns)} user-defined columns")
 
-    # Load data
-    df.to_sql(metadata_table.name, con=engine, if_exists='append', index=False)
-    logger.info(f"Imported {df.shape[0]} images into metadata table")
+    # Load data one chunk at a time, so that memory use doesn't grow with the CSV size
+    table_column_names = ['zarr_path'] + [col2slug[c] for c in columns]
+    count = 0
+    for df in read_csv_chunks(metadata_path, csv_columns):
+
+        # Process metadata into table format
+        df.columns = table_column_names
+        df.insert(0, 'collection', fs.fsroot)
+
+        # Trailing slashes would prevent matching against discovered zarr paths
+        df['zarr_path'] = df['zarr_path'].str.rstrip('/')
+        zarr_names = df['zarr_path'].str.replace(r'\.[^./]*$', '', regex=True)
+
+        if args.aux_image_name:
+            df['aux_image_path'] = get_aux_paths(zarr_names, args.aux_image_name)
+
+        if args.thumbnail_name:
+            df['thumbnail_path'] = get_aux_paths(zarr_names, args.thumbnail_name)
+
+        df.to_sql(metadata_table.name, con=engine, if_exists='append', index=False)
+        count += df.shape[0]
+        logger.debug(f"Imported {count} images so far")
+
+    logger.info(f"Imported {count} images into metadata table")
 
 elif not overwrite:
     logger.info("Metadata table already exists. Pass --overwrite if you want to recreate it.")
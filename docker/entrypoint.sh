@@ -12,6 +12,7 @@ export DATA_URL="${DATA_URL:=/data}"
 
 set -x
 uvicorn zarrcade.serve:app --access-log \
+    --loop uvloop --http httptools \
     --workers $WORKERS --host $HOST --port $PORT \
     --forwarded-allow-ips='*' --proxy-headers \
     --ssl-keyfile "$KEY_FILE" --ssl-certfile "$CERT_FILE" "$@"
\ No newline at end of file
@@ -0,0 +1,4 @@
+import os
+
+# The settings require a data location, even though these tests don't use it
+os.environ.setdefault('ZARRCADE_DATA_URL', os.path.dirname(__file__))
@@ -0,0 +1,53 @@
+import time
+
+from zarrcade.database import Database, PERSIST_BATCH_SIZE
+from zarrcade.model import Image, Channel, Axis
+
+
+def make_image(i):
+    return Image(
+        relative_path=f"image{i}.zarr/0",
+        zarr_path=f"image{i}.zarr",
+        group_path="/0",
+        num_channels=1,
+        num_timepoints=1,
+        dimensions="1",
+        dimensions_voxels="1",
+        chunk_size="1",
+        voxel_sizes="1",
+        compression="none",
+        channels=[Channel("c0", "FF0000")],
+        axes={'x': Axis('x', 1.0, 'um', 10, 5)},
+        axes_order="x"
+    )
+
+
+def test_persist_images_notifies_once():
+    db = Database('sqlite:///:memory:')
+    notifications = []
+    db.add_change_listener(lambda: notifications.append(db.get_images_count()))
+
+    num_images = 2 * PERSIST_BATCH_SIZE + 1
+    db.persist_images('', lambda: (make_image(i) for i in range(num_images)))
+
+    assert notifications == [num_images]
+
+
+def test_changes_from_other_processes_are_detected(tmp_path):
+    db_url = f"sqlite:///{tmp_path / 'test.db'}"
+    db = Database(db_url, change_check_interval=0.001)
+    notifications = []
+    db.add_change_listener(lambda: notifications.append(db.get_images_count()))
+
+    # Nothing to report if the database hasn't changed
+    time.sleep(0.01)
+    db.check_for_changes()
+    assert notifications == []
+
+    # Another writer, with its own connections, persists some images
+    other_db = Database(db_url)
+    other_db.persist_images('', lambda: (make_image(i) for i in range(3)))
+
+    time.sleep(0.01)
+    db.check_for_changes()
+    assert notifications == [3]
@@ -0,0 +1,92 @@
+import os
+import signal
+
+import pytest
+from fastapi.testclient import TestClient
+
+from zarrcade.model import Image, Channel, Axis
+from zarrcade.serve import app, get_byte_range
+
+# A file outside of the data root, which is the tests directory
+OUTSIDE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'README.md'))
+
+
+@pytest.fixture(scope='module')
+def client():
+    # The test client starts the app outside of the main thread,
+    # where the startup event cannot install its SIGINT handler
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(signal, 'signal', lambda *args: None)
+        with TestClient(app) as client:
+            yield client
+
+
+@pytest.mark.parametrize('method', ['GET', 'HEAD'])
+def test_data_inside_root(client, method):
+    response = client.request(method, '/data/conftest.py')
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('method', ['GET', 'HEAD'])
+@pytest.mark.parametrize('url', [
+    '/data/%2E%2E/README.md',
+    '/data/sub/%2E%2E/%2E%2E/README.md',
+    '/data/' + OUTSIDE_PATH,
+])
+def test_data_outside_root(client, method, url):
+    response = client.request(method, url)
+    assert response.status_code == 404
+    assert not response.content
+
+
+def test_neuroglancer_state_lowercase_color(client):
+    axes = {name: Axis(name, 1.0, 'um', 8, 8) for name in 'tczyx'}
+    image = Image(
+        relative_path="lowercase.zarr/",
+        zarr_path="lowercase.zarr",
+        group_path="/",
+        num_channels=2,
+        num_timepoints=1,
+        dimensions="8",
+        dimensions_voxels="8",
+        chunk_size="8",
+        voxel_sizes="1",
+        compression="none",
+        channels=[Channel("GFP", "00ff00", 0, 4096, 0, 100),
+                  Channel("RFP", "red", 0, 4096, 0, 100)],
+        axes=axes,
+        axes_order="tczyx"
+    )
+    app.db.persist_image(app.fs.fsroot, image, None)
+
+    response = client.get('/neuroglancer/lowercase.zarr/')
+    assert response.status_code == 200
+    shaders = [layer['shader'] for layer in response.json()['layers']]
+    assert 'default="#00ff00"' in shaders[0]
+    assert 'default="red"' in shaders[1]
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, None),
+    ('bytes=0-99', (0, 100)),
+    ('bytes=10-', (10, 1000)),
+    ('bytes=990-2000', (990, 1000)),
+    ('bytes=-100', (900, 1000)),
+    ('bytes=-2000', (0, 1000)),
+    ('bytes=999-999', (999, 1000)),
+    # Invalid or unsupported ranges are ignored
+    ('bytes=5-2', None),
+    ('bytes=-', None),
+    ('bytes=a-b', None),
+    ('items=0-99', None),
+    ('bytes=0-99,200-299', None),
+    ('bytes=0-99, -100', None),
+])
+def test_get_byte_range(header, expected):
+    assert get_byte_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header', ['bytes=1000-', 'bytes=1000-1100', 'bytes=2000-', 'bytes=-0'])
+def test_get_byte_range_unsatisfiable(header):
+    start, end = get_byte_range(header, 1000)
+    assert start >= end
@@ -1,12 +1,17 @@
 import json
+import time
+from operator import itemgetter
 from dataclasses import asdict
 from typing import Iterator, Dict
 from collections import defaultdict 
+from threading import Lock
 
 import pandas as pd
+from cachetools import TTLCache
 from loguru import logger
-from sqlalchemy import create_engine, text, MetaData, Table, Column, \
-    String, Integer, Index, ForeignKey, func, select, distinct
+from sqlalchemy import create_engine, event, text, MetaData, Table, Column, \
+    String, Integer, Index, ForeignKey, func, select, distinct, bindparam, make_url
+from sqlalchemy.pool import StaticPool
 
 from zarrcade.model import Image, MetadataImage
 from zarrcade.settings import get_settings
@@ -17,7 +22,7 @@ if get_settings().debug_sql:
     logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 
 IMAGES_AND_METADATA_SQL = text("""
-    SELECT m.*, i.image_path, i.image_info
+    SELECT m.*, i.id AS image_id, i.image_path, i.image_info
     FROM 
         images i
     LEFT JOIN 
@@ -30,6 +35,9 @@ LIMIT_AND_OFFSET = text("""
     LIMIT :limit OFFSET :offset
 """)
 
+# Number of images to write to the database in a single transaction
+PERSIST_BATCH_SIZE = 1000
+
 def deserialize_image_info(image_info: str) -> Image:
     """ Deserialize the Image from a JSON string.
     """
@@ -41,28 +49,85 @@ def serialize_image_info(image: Image) -> str:
     return json.dumps(asdict(image))
 
 
+def is_in_memory(db_url: str) -> bool:
+    """ Returns true if the given URL points to an in-memory SQLite database, 
+        which is private to the process that opens it.
+    """
+    url = make_url(db_url)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """ Use write-ahead logging for SQLite, so that persisting images only 
+        syncs to disk at checkpoints, and does not block readers.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
 class Database:
     """ Database which contains cached information about discovered images,
         as well as optional metadata for supporting searchability.
     """
 
-    def __init__(self, db_url: str):
-
-        # Initialize database
-        self.engine = create_engine(db_url)
+    def __init__(self, db_url: str, query_cache_ttl: int = 0, pool_options: Dict = None,
+            change_check_interval: float = 0, sqlite_wal: bool = False):
+
+        # Initialize database. In-memory SQLite databases live inside a 
+        # single connection, which is shared by the threads that query it.
+        if is_in_memory(db_url):
+            self.engine = create_engine(db_url, poolclass=StaticPool,
+                connect_args={'check_same_thread': False})
+        elif pool_options:
+            self.engine = create_engine(db_url, **pool_options)
+            logger.debug(f"Database connection pool: {self.engine.pool.status()}")
+        else:
+            self.engine = create_engine(db_url)
+        # Write-ahead logging needs shared memory, so it's only used when 
+        # requested, for databases on local (not network) filesystems
+        if sqlite_wal and self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine, 'connect', configure_sqlite_connection)
         self.meta = MetaData()
         self.meta.reflect(bind=self.engine)
         self.metadata_table, self.images_table = self.create_tables()
 
+        # Callbacks to invoke after images are written
+        self.change_listeners = []
+
+        # Optionally check for writes made by other processes (e.g. init_db.py), 
+        # at most once per interval. SQLite reports them through the data 
+        # version of a dedicated connection, while other databases are assumed 
+        # to have changed whenever the interval has passed.
+        self.change_check_interval = change_check_interval
+        if change_check_interval:
+            self.change_check_lock = Lock()
+            self.last_change_check = time.monotonic()
+            self.version_connection = None
+            if self.engine.dialect.name == 'sqlite' and not is_in_memory(db_url):
+                self.version_connection = self.engine.raw_connection()
+            self.data_version = self.get_data_version()
+
+        # Search queries only vary by which clauses are present, 
+        # so their text is built once for each combination
+        self.search_queries = {}
+
+        # Optionally cache search results for a short time, since the 
+        # same pages (e.g. the unfiltered first page) are requested often
+        self.query_cache = None
+        if query_cache_ttl:
+            self.query_cache = TTLCache(maxsize=256, ttl=query_cache_ttl)
+            self.query_cache_lock = Lock()
+            self.add_change_listener(self.clear_query_cache)
+
         # Read the attribute naming map from the database, if they exist
         self.column_map = {}
         self.reverse_column_map = {}
         if 'metadata_columns' in self.meta.tables:
             query = "SELECT * FROM metadata_columns"
             result_df = pd.read_sql_query(query, con=self.engine)
-            for row in result_df.itertuples():
-                db_name = row.db_name
-                original_name = row.original_name
+            for db_name, original_name in zip(result_df['db_name'], result_df['original_name']):
                 logger.trace(f"Registering column '{db_name}' for {original_name}")
                 self.column_map[db_name] = original_name
                 self.reverse_column_map[original_name] = db_name
@@ -125,6 +190,23 @@ class Database:
         return metadata
 
 
+    def get_metadata_reader(self, columns):
+        """ Returns a function which gets the image metadata out of a plain
+            row tuple with the given columns and returns it as a dictionary.
+        """
+        col_pos = {c: i for i, c in enumerate(columns)}
+        items = [(col_pos[k], v) for k, v in self.column_map.items() if k in col_pos]
+        if not items:
+            return lambda row: {}
+
+        names = [name for _, name in items]
+        getter = itemgetter(*[i for i, _ in items])
+        if len(items) == 1:
+            # itemgetter returns a bare value instead of a tuple for one item
+            return lambda row: {names[0]: getter(row)}
+        return lambda row: dict(zip(names, getter(row)))
+
+
     def get_images_count(self):
         """ Get the total number of images in the database.
         """
@@ -144,8 +226,8 @@ class Database:
         metadata_ids = {}
         query = "SELECT id,zarr_path FROM metadata WHERE collection = :collection"
         result_df = pd.read_sql_query(query, con=self.engine, params={'collection': collection})
-        for row in result_df.itertuples():
-            metadata_ids[row.zarr_path] = row.id
+        for zarr_path, metadata_id in zip(result_df['zarr_path'], result_df['id']):
+            metadata_ids[zarr_path] = metadata_id
         return metadata_ids
 
 
@@ -163,6 +245,7 @@ class Database:
         logger.info(f"Loaded {len(metadata_ids)} metadata ids")
         # Walk the storage root and populate the database
         count = 0
+        batch = []
 
         for image in image_generator():
             relative_path = image.zarr_path
@@ -173,58 +256,133 @@ class Database:
 
             if metadata_id or not only_with_metadata:
                 logger.debug(f"Persisting {image}")
-                self.persist_image(
-                            collection=collection,
-                            image=image,
-                            metadata_id=metadata_id
-                )
+                batch.append((image, metadata_id))
                 count += 1
+                if len(batch) >= PERSIST_BATCH_SIZE:
+                    self._write_image_batch(collection, batch)
+                    batch = []
             else:
                 logger.debug(f"Skipping image missing metadata: {image.zarr_path}")
 
+        if batch:
+            self._write_image_batch(collection, batch)
+
         logger.info(f"Persisted {count} images to the database")
+        self._notify_change_listeners()
 
 
     def persist_image(self, collection: str, image: Image, metadata_id: int):
         """ Persist (update or insert) the given image.
         """
-        image_path = image.relative_path
-        zarr_path = image.zarr_path
-        group_path = image.group_path
-        image_info = serialize_image_info(image)
+        self.persist_image_batch(collection, [(image, metadata_id)])
+
+
+    def add_change_listener(self, listener):
+        """ Register a function to be called (without arguments) whenever 
+            images are written to the database, e.g. to invalidate caches.
+        """
+        self.change_listeners.append(listener)
+
+
+    def get_data_version(self):
+        """ Returns a value which changes whenever another process commits 
+            to the database, or None if the database can't report it.
+        """
+        if self.version_connection is None:
+            return None
+        cursor = self.version_connection.cursor()
+        try:
+            cursor.execute("PRAGMA data_version")
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+
+    def check_for_changes(self):
+        """ Notifies the change listeners if the database was written by 
+            another process since the last check. Does nothing if it's been 
+            less than the change check interval since the last check.
+        """
+        if not self.change_check_interval:
+            return
+
+        with self.change_check_lock:
+            now = time.monotonic()
+            if now - self.last_change_check < self.change_check_interval:
+                return
+            self.last_change_check = now
+            data_version = self.get_data_version()
+            if data_version is not None and data_version == self.data_version:
+                return
+            self.data_version = data_version
+
+        logger.info("Reloading cached data after database changes")
+        self._notify_change_listeners()
+
+
+    def clear_query_cache(self):
+        """ Discard any cached search results.
+        """
+        if self.query_cache is not None:
+            with self.query_cache_lock:
+                self.query_cache.clear()
+
+
+    def persist_image_batch(self, collection: str, batch: list[tuple[Image, int]]):
+        """ Persist (update or insert) a batch of (image, metadata_id) tuples
+            in a single transaction.
+        """
+        self._write_image_batch(collection, batch)
+        self._notify_change_listeners()
+
+
+    def _notify_change_listeners(self):
+        for listener in self.change_listeners:
+            listener()
+
+
+    def _write_image_batch(self, collection: str, batch: list[tuple[Image, int]]):
+        rows = [{
+                'collection': collection,
+                'zarr_path': image.zarr_path,
+                'group_path': image.group_path,
+                'image_path': image.relative_path,
+                'image_info': serialize_image_info(image),
+                'metadata_id': metadata_id
+            } for image, metadata_id in batch]
 
         with self.engine.begin() as conn:
-            stmt = select(self.images_table).\
-                where((self.images_table.c.collection == collection) & 
-                    (self.images_table.c.image_path == image_path))
-            existing_row = conn.execute(stmt).fetchone()
+            image_paths = [row['image_path'] for row in rows]
+            stmt = select(self.images_table.c.image_path).\
+                where((self.images_table.c.collection == collection) &
+                    (self.images_table.c.image_path.in_(image_paths)))
+            existing_paths = {row.image_path for row in conn.execute(stmt)}
+
+            inserts = [row for row in rows if row['image_path'] not in existing_paths]
+            updates = [{f"b_{k}": v for k, v in row.items()}
+                       for row in rows if row['image_path'] in existing_paths]
 
-            if existing_row:
+            if updates:
                 update_stmt = self.images_table.update(). \
-                    where((self.images_table.c.collection == collection) &
-                            (self.images_table.c.image_path == image_path)). \
-                    values(zarr_path=zarr_path,
-                            group_path=group_path,
-                            image_info=image_info,
-                            metadata_id=metadata_id)
-                conn.execute(update_stmt)
-                logger.info(f"Updated {image_path}")
-            else:
-                insert_stmt = self.images_table.insert() \
-                        .values(collection=collection,
-                                zarr_path=zarr_path,
-                                group_path=group_path,
-                                image_path=image_path,
-                                image_info=image_info,
-                                metadata_id=metadata_id)
-                conn.execute(insert_stmt)
-                logger.info(f"Inserted {image_path}")
+                    where((self.images_table.c.collection == bindparam('b_collection')) &
+                            (self.images_table.c.image_path == bindparam('b_image_path'))). \
+                    values(zarr_path=bindparam('b_zarr_path'),
+                            group_path=bindparam('b_group_path'),
+                            image_info=bindparam('b_image_info'),
+                            metadata_id=bindparam('b_metadata_id'))
+                conn.execute(update_stmt, updates)
+                logger.info(f"Updated {len(updates)} images")
+
+            if inserts:
+                conn.execute(self.images_table.insert(), inserts)
+                logger.info(f"Inserted {len(inserts)} images")
 
 
     def get_metaimage(self, image_path: str):
         """ Returns the MetadataImage for the given image path, or 
             None if it doesn't exist.
         """
+        self.check_for_changes()
         full_query = text(f"{IMAGES_AND_METADATA_SQL} WHERE i.image_path = :image_path")
         result_df = pd.read_sql_query(full_query, con=self.engine, params={'image_path': image_path})
         for row in result_df.itertuples():
@@ -253,7 +411,8 @@ class Database:
             search_string: str = '',
             filter_params: Dict[str,str] = None,
             page: int = 1,
-            page_size: int = 10
+            page_size: int = 10,
+            after: int = None
         ):
         """
         Find meta images with optional search and pagination.
@@ -262,6 +421,9 @@ class Database:
             search_string (str): The string to search for within image metadata.
             page (int): The one-indexed page number.
             page_size (int): The number of results per page.
+            after (int): Optional image id of the last result on the previous 
+                page. When given, the page starts after this image instead of 
+                skipping over all the previous results.
 
         Returns:
             tuple: A tuple containing:
@@ -271,52 +433,133 @@ class Database:
         if page < 0:
             raise ValueError("Page index must be a non-negative integer.")
 
-        offset = (page - 1) * page_size
+        self.check_for_changes()
+
+        filter_params = filter_params or {}
+        if self.query_cache is None:
+            return self._find_metaimages(search_string, filter_params, page, page_size, after)
+
+        key = (search_string, tuple(sorted(filter_params.items())), page, page_size, after)
+        with self.query_cache_lock:
+            result = self.query_cache.get(key)
+        if result is None:
+            result = self._find_metaimages(search_string, filter_params, page, page_size, after)
+            with self.query_cache_lock:
+                self.query_cache[key] = result
+        return result
+
+
+    def get_search_queries(self, has_search: bool, filter_names: tuple, has_after: bool):
+        """ Return the (paginated, count) queries for a search with the given 
+            clauses. The queries are built once and reused for later searches.
+        """
+        key = (has_search, filter_names, has_after)
+        queries = self.search_queries.get(key)
+        if queries:
+            return queries
 
-        # Base queries for fetching data and counting total records
         base_query = IMAGES_AND_METADATA_SQL
         where_clause = ''
-        params = {}
 
-        if search_string:
+        if has_search:
             search_columns = [f"m.{k}" for k in self.column_map] + ['i.zarr_path']
             or_clauses = " OR ".join([f"{col} LIKE :search_string" for col in search_columns])
             where_clause += f" AND ({or_clauses})"
+
+        for db_name in filter_names:
+            where_clause += f" AND (m.{db_name} LIKE :{db_name}_value)"
+
+        count_query = text(f"SELECT COUNT(*) FROM ({base_query} WHERE 1=1{where_clause}) q")
+
+        if has_after:
+            # Seek past the previous page using the image id, which is indexed, 
+            # instead of having the database skip over all the earlier rows
+            paginated_query = text(f"SELECT q.* "
+                                   f"FROM ({base_query} WHERE 1=1{where_clause} AND (i.id > :after)) q "
+                                   f"ORDER BY q.image_id "
+                                   f"LIMIT :limit")
+        else:
+            paginated_query = text(f"SELECT q.* "
+                                   f"FROM ({base_query} WHERE 1=1{where_clause}) q "
+                                   f"ORDER BY q.image_id "
+                                   f"LIMIT :limit OFFSET :offset")
+
+        queries = self.search_queries[key] = (paginated_query, count_query)
+        return queries
+
+
+    def count_metaimages(self, search_string, filter_params, count_query, params):
+        """ Return the total number of images matching the given search. 
+            The count doesn't depend on the page, so it's cached separately 
+            from the search results, when caching is enabled.
+        """
+        if self.query_cache is None:
+            return int(pd.read_sql_query(count_query, con=self.engine, params=params).iloc[0, 0])
+
+        key = ('count', search_string, tuple(sorted(filter_params.items())))
+        with self.query_cache_lock:
+            total_count = self.query_cache.get(key)
+        if total_count is None:
+            total_count = int(pd.read_sql_query(count_query, con=self.engine, params=params).iloc[0, 0])
+            with self.query_cache_lock:
+                self.query_cache[key] = total_count
+        return total_count
+
+
+    def _find_metaimages(self, search_string, filter_params, page, page_size, after):
+        params = {}
+        if search_string:
             params['search_string'] = f'%{search_string}%'
 
         for db_name in filter_params:
-            where_clause += f" AND (m.{db_name} LIKE :{db_name}_value)"
             params[f"{db_name}_value"] = f'%{filter_params[db_name]}%'
 
-        paginated_query = text(f"{base_query} WHERE 1=1{where_clause} LIMIT :limit OFFSET :offset")
-        count_query = text(f"SELECT COUNT(*) FROM ({base_query} WHERE 1=1{where_clause})")
+        paginated_query, count_query = self.get_search_queries(
+            bool(search_string), tuple(sorted(filter_params)), after is not None)
 
-        result_df = pd.read_sql_query(paginated_query, con=self.engine, params=params | {
-            'limit': page_size,
-            'offset': offset
-        })
-        total_count = pd.read_sql_query(count_query, con=self.engine, params=params).iloc[0, 0]
+        # When seeking, the cursor alone determines where the page starts
+        page_params = {'limit': page_size}
+        if after is None:
+            page_params['offset'] = (page - 1) * page_size
+        else:
+            page_params['after'] = after
+
+        result_df = pd.read_sql_query(paginated_query, con=self.engine, params=params | page_params)
+        total_count = self.count_metaimages(search_string, filter_params, count_query, params)
 
         # Calculate the total number of pages
         total_pages = (total_count + page_size - 1) // page_size
 
+        # Resolve column positions once, and iterate over plain tuples
+        col_pos = {c: i for i, c in enumerate(result_df.columns)}
+        get_metadata = self.get_metadata_reader(result_df.columns)
+        image_info_pos = col_pos['image_info']
+        image_path_pos = col_pos['image_path']
+        aux_image_path_pos = col_pos['aux_image_path']
+        thumbnail_path_pos = col_pos['thumbnail_path']
+
         images = []
-        for row in result_df.itertuples():
-            metadata = self.get_tuple_metadata(row)
-            image_info_json = row.image_info
-            image_path = row.image_path
+        for row in result_df.itertuples(index=False, name=None):
+            metadata = get_metadata(row)
+            image_info_json = row[image_info_pos]
+            image_path = row[image_path_pos]
             if image_info_json:
                 image = deserialize_image_info(image_info_json)
                 metaimage = MetadataImage(
                     id=image_path,
                     image=image,
-                    aux_image_path=row.aux_image_path,
-                    thumbnail_path=row.thumbnail_path,
+                    aux_image_path=row[aux_image_path_pos],
+                    thumbnail_path=row[thumbnail_path_pos],
                     metadata=metadata
                 )
                 logger.trace(f"matched {metaimage.id}")
                 images.append(metaimage)
 
+        # Cursor for seeking to the next page
+        next_after = None
+        if not result_df.empty:
+            next_after = int(result_df['image_id'].iloc[-1])
+
         start_num = ((page-1) * page_size) + 1
         end_num = start_num + page_size - 1
         if end_num > total_count: 
@@ -330,7 +573,8 @@ class Database:
                 'total_pages': total_pages,
                 'total_count': total_count,
                 'start_num': start_num,
-                'end_num': end_num
+                'end_num': end_num,
+                'next_after': next_after
             }
         }
 
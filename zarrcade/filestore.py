@@ -1,15 +1,43 @@
 import os
-from typing import Iterator
+import re
+import asyncio
+import posixpath
+import hashlib
+from threading import Lock
+from contextlib import nullcontext
+from typing import Iterator, AsyncIterator
 from urllib.parse import urlparse
 
 import fsspec
-import s3fs
+from cachetools import TTLCache
 from loguru import logger
 
 from zarrcade.model import Image
 from zarrcade.images import yield_ome_zarrs, yield_images
 
 
+# Zarr chunk keys, e.g. "0.0.0", or the last part of "0/0/0" or "c/0/0/0"
+CHUNK_KEY_RE = re.compile(r'^\d+(\.\d+)*$')
+
+
+def is_chunk_key(relative_path: str):
+    """ Returns true if the given relative path names a zarr chunk. Chunks
+        are written once, unlike metadata, thumbnails and other files 
+        which may be rewritten in place.
+    """
+    return CHUNK_KEY_RE.match(relative_path.rpartition('/')[2]) is not None
+
+
+def normalize_relative_path(relative_path: str):
+    """ Returns the given relative path in normal form, or None if it 
+        would escape the root it's relative to (e.g. by using "..").
+    """
+    path = posixpath.normpath(relative_path)
+    if path.startswith('/') or path == '..' or path.startswith('../'):
+        return None
+    return path
+
+
 def get_fs(url:str):
     """ Parsers the given URL and returns an fsspec filesystem along with
         a root path and web-accessible URL.
@@ -30,12 +58,44 @@ def get_fs(url:str):
     return fs, fsroot, web_url
 
 
+def get_file_stat(info):
+    """ Returns the size and an ETag for a file, given its fsspec info. 
+        The ETag is the one reported by the store (e.g. S3) if available, 
+        otherwise it's derived from the modification time and size.
+    """
+    size = info['size']
+    etag = info.get('ETag') or info.get('etag')
+    if etag:
+        if not etag.startswith('"'):
+            etag = f'"{etag}"'
+        return size, etag
+
+    mtime = info.get('mtime') or info.get('LastModified')
+    if mtime is None:
+        return size, None
+    etag_base = f"{mtime}-{size}"
+    return size, '"' + hashlib.md5(etag_base.encode()).hexdigest() + '"'
+
+
+def get_object_store(fsroot: str):
+    """ Returns an obstore S3 store rooted at the given bucket path, 
+        or None if obstore is not installed.
+    """
+    try:
+        from obstore.store import S3Store
+    except ImportError:
+        logger.warning("obstore is not installed, falling back to s3fs")
+        return None
+    bucket, _, prefix = fsroot.strip('/').partition('/')
+    return S3Store(bucket, prefix=prefix or None)
+
+
 class Filestore:
     """ Filestore containing images. May be on a local filesystem, 
         or any remote filesystem supported by FSSPEC.
     """
 
-    def __init__(self, data_url):
+    def __init__(self, data_url, stat_cache_ttl=0, use_obstore=False, max_concurrent_io=0):
         self.fs, self.fsroot, self.url = get_fs(data_url)
         logger.info(f"Filesystem root is {self.fsroot}")
 
@@ -43,6 +103,36 @@ class Filestore:
         self.fsroot_dir = os.path.join(self.fsroot, '')
         logger.trace(f"Filesystem dir is {self.fsroot_dir}")
 
+        # Protocol to prepend to absolute paths when opening zarrs
+        # TODO: move this logic somewhere else
+        self.zarr_url_prefix = ''
+        # Checking the protocol avoids importing s3fs for other filesystems
+        protocols = self.fs.protocol
+        if isinstance(protocols, str):
+            protocols = (protocols,)
+        if 's3' in protocols:
+            self.zarr_url_prefix = 's3://'
+
+        # Optionally cache the sizes of chunks, to avoid a metadata round-trip 
+        # (e.g. an S3 HEAD request) every time the same chunk is served. 
+        # Other files may change, so they are always looked up.
+        self.stat_cache = None
+        if stat_cache_ttl:
+            self.stat_cache = TTLCache(maxsize=100_000, ttl=stat_cache_ttl)
+            self.stat_cache_lock = Lock()
+
+        # Optionally serve S3 data through obstore's native (Rust) client, 
+        # which has much less per-request overhead than s3fs
+        self.store = None
+        if use_obstore and self.zarr_url_prefix == 's3://':
+            self.store = get_object_store(self.fsroot)
+
+        # Optionally bound the number of concurrent async filesystem operations, 
+        # so that a burst of chunk requests doesn't exhaust threads or sockets
+        self.io_limit = nullcontext()
+        if max_concurrent_io:
+            self.io_limit = asyncio.Semaphore(max_concurrent_io)
+
 
     def yield_images(self) -> Iterator[Image]:
         """ Discover images in the filestore 
@@ -51,10 +141,7 @@ class Filestore:
         logger.info(f"Discovering images in {self.fsroot}")
         for relative_path in yield_ome_zarrs(self):
             logger.trace(f"Found images in {relative_path}")
-            absolute_path = os.path.join(self.fsroot_dir, relative_path)
-            # TODO: move this logic somewhere else
-            if isinstance(self.fs, s3fs.core.S3FileSystem):
-                absolute_path = 's3://' + absolute_path
+            absolute_path = self.zarr_url_prefix + os.path.join(self.fsroot_dir, relative_path)
 
             logger.trace(f"Reading images in {absolute_path}")
             for image in yield_images(absolute_path, relative_path):
@@ -68,6 +155,20 @@ class Filestore:
         return isinstance(self.fs, fsspec.implementations.local.LocalFileSystem)
 
 
+    def get_local_path(self, relative_path):
+        """ Returns the local filesystem path to the given relative path, 
+            or None if the filestore is not local or the path is outside 
+            of the filestore.
+        """
+        if not self.is_local():
+            return None
+        root_dir = os.path.join(os.path.normpath(self.fsroot), '')
+        path = os.path.normpath(self.get_absolute_path(relative_path))
+        if not path.startswith(root_dir):
+            return None
+        return path
+
+
     def get_absolute_path(self, relative_path):
         """ Returns the full absolute path to the given path.
         """
@@ -81,20 +182,171 @@ class Filestore:
         return self.fs.exists(path)
 
 
-    def open(self, relative_path):
+    def find(self, relative_path):
+        """ Returns the relative paths of all files under the given 
+            relative path, using a single recursive listing.
+        """
+        path = self.get_absolute_path(relative_path)
+        if not self.fs.exists(path):
+            return []
+        return [os.path.relpath(p, self.fsroot) for p in self.fs.find(path)]
+
+
+    def open(self, relative_path, size=None):
         """ Opens the file at the given relative path and returns
-            the file handle.
+            the file handle. If the size of the file is already known, 
+            it can be passed in to save the filesystem from looking it up.
         """
         path = self.get_absolute_path(relative_path)
-        return self.fs.open(path)
+        if size is None:
+            return self.fs.open(path)
+        return self.fs.open(path, size=size)
 
 
     def get_size(self, relative_path):
         """ Returns the size of the file at the given relative path.
         """
+        return self.get_stat(relative_path)[0]
+
+
+    def get_stat(self, relative_path):
+        """ Returns the size and ETag of the file at the given relative path.
+        """
+        stat = self._get_cached_stat(relative_path)
+        if stat is None:
+            path = self.get_absolute_path(relative_path)
+            stat = get_file_stat(self.fs.info(path))
+            self._cache_stat(relative_path, stat)
+        return stat
+
+
+    def is_async(self):
+        """ Returns true if the underlying filesystem has a native 
+            async implementation (e.g. S3 or HTTP), false otherwise.
+        """
+        return getattr(self.fs, 'async_impl', False)
+
+
+    async def get_size_async(self, relative_path):
+        """ Returns the size of the file at the given relative path, 
+            without blocking the calling event loop.
+        """
+        return (await self.get_stat_async(relative_path))[0]
+
+
+    async def get_stat_async(self, relative_path):
+        """ Returns the size and ETag of the file at the given relative path, 
+            without blocking the calling event loop.
+        """
+        stat = self._get_cached_stat(relative_path)
+        if stat is None:
+            stat = get_file_stat(await self._get_info_async(relative_path))
+            self._cache_stat(relative_path, stat)
+        return stat
+
+
+    async def iter_blocks(self, relative_path, size, block_size, 
+            start=0, end=None) -> AsyncIterator[bytes]:
+        """ Yields the contents of the file at the given relative path in 
+            blocks of the given size, without blocking the calling event loop.
+            Optionally, only the bytes from start up to (but excluding) end 
+            are read. Objects in obstore are streamed, async filesystems fetch 
+            each block with a ranged read, and other filesystems read from a 
+            file handle in a worker thread.
+        """
+        if end is None:
+            end = size
         path = self.get_absolute_path(relative_path)
-        info = self.fs.info(path)
-        return info['size']
+        if self.store is not None:
+            options = None
+            if start > 0 or end < size:
+                options = {'range': (start, end)}
+            async with self.io_limit:
+                result = await self.store.get_async(relative_path, options=options)
+            async for block in result.stream(min_chunk_size=block_size):
+                yield bytes(block)
+        elif self.is_async():
+            for block_start in range(start, end, block_size):
+                block_end = min(block_start + block_size, end)
+                async with self.io_limit:
+                    block = await self._run_async(
+                        self.fs._cat_file(path, start=block_start, end=block_end))
+                yield block
+        else:
+            async with self.io_limit:
+                f = await asyncio.to_thread(self.open, relative_path, size)
+            try:
+                if start:
+                    await asyncio.to_thread(f.seek, start)
+                remaining = end - start
+                while remaining > 0:
+                    async with self.io_limit:
+                        block = await asyncio.to_thread(f.read, min(block_size, remaining))
+                    if not block:
+                        break
+                    remaining -= len(block)
+                    yield block
+            finally:
+                await asyncio.to_thread(f.close)
+
+
+    async def _get_info_async(self, relative_path):
+        """ Returns the fsspec-style info for the file at the given 
+            relative path, raising FileNotFoundError if it doesn't exist.
+        """
+        if self.store is not None:
+            from obstore.exceptions import NotFoundError
+            try:
+                async with self.io_limit:
+                    meta = await self.store.head_async(relative_path)
+            except NotFoundError as e:
+                raise FileNotFoundError(relative_path) from e
+            return {'size': meta['size'], 'ETag': meta['e_tag'], 
+                    'mtime': meta['last_modified']}
+
+        path = self.get_absolute_path(relative_path)
+        async with self.io_limit:
+            if self.is_async():
+                return await self._run_async(self.fs._info(path))
+            return await asyncio.to_thread(self.fs.info, path)
+
+
+    def _run_async(self, coro):
+        """ Schedules a coroutine of the async filesystem on the filesystem's 
+            own event loop, and returns an awaitable for its result.
+        """
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.fs.loop))
+
+
+    def warm_up(self, prefetch_sizes=False):
+        """ Lists the root of the filestore so that the first request does 
+            not pay for setting up the connection (e.g. S3 session and bucket 
+            location). Optionally, the sizes of all chunks in the filestore are 
+            listed and cached up front, so that they are served without a 
+            metadata round-trip.
+        """
+        if prefetch_sizes and self.stat_cache is not None:
+            logger.info(f"Prefetching chunk sizes in {self.fsroot}")
+            files = self.fs.find(self.fsroot, detail=True).values()
+        else:
+            files = self.fs.ls(self.fsroot, detail=True)
+
+        for info in files:
+            if info['type'] == 'file':
+                self._cache_stat(os.path.relpath(info['name'], self.fsroot), get_file_stat(info))
+
+
+    def _get_cached_stat(self, relative_path):
+        if self.stat_cache is None:
+            return None
+        with self.stat_cache_lock:
+            return self.stat_cache.get(relative_path)
+
+
+    def _cache_stat(self, relative_path, stat):
+        if self.stat_cache is not None and is_chunk_key(relative_path):
+            with self.stat_cache_lock:
+                self.stat_cache[relative_path] = stat
 
 
     def get_children(self, relative_path):
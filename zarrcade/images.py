@@ -1,12 +1,39 @@
 import os
 import re
+import fnmatch
 import itertools
+from concurrent.futures import ThreadPoolExecutor
+
 import zarr
+from zarr.storage import FSStore, LRUStoreCache
 
 from loguru import logger
 
 from zarrcade.model import Image, Channel, Axis
 
+# TODO: temporary hack for dealing with CellMap data
+EXCLUDED_DIR_GLOBS = ['*.n5', '*align', 'mag*', 'raw', 'dat', 'tiles_destreak']
+
+
+def compile_globs(patterns):
+    """ Combine the given glob patterns into a single compiled regex
+        which matches a name if any of the globs match it.
+    """
+    return re.compile('|'.join(f"(?:{fnmatch.translate(p)})" for p in patterns))
+
+
+EXCLUDED_DIR_RE = compile_globs(EXCLUDED_DIR_GLOBS)
+
+# Number of directory listings to run concurrently during discovery
+DISCOVERY_THREADS = min(32, 2 * (os.cpu_count() or 1))
+
+# Maximum bytes of zarr metadata cached per container while reading its images
+ZARR_CACHE_SIZE = 64 * 2**20
+
+# Runs of slashes to collapse in array paths
+SLASHES_RE = re.compile('/+')
+
+
 def get(mydict, key, default=None):
     if not mydict:
         return default
@@ -25,7 +52,8 @@ def encode_image(zarr_path, image_group):
 
     group_path = image_group.name
     array_path = group_path+'/'+fullres_dataset['path']
-    array_path, _ = re.subn('/+', '/', array_path)
+    if '//' in array_path:
+        array_path = SLASHES_RE.sub('/', array_path)
 
     if array_path not in image_group:
         paths = ', '.join(image_group.keys())
@@ -127,7 +155,10 @@ def yield_nested_image_groups(z):
 def yield_image_groups(url):
     ''' Interrogates the OME-Zarr at the given URL and yields all of the 2-5D images within.
     '''
-    z = zarr.open(url, mode='r')
+    # Walking nested groups reads the same metadata keys and directory 
+    # listings repeatedly, so they are cached for the lifetime of the walk
+    store = LRUStoreCache(FSStore(url, mode='r'), max_size=ZARR_CACHE_SIZE)
+    z = zarr.open(store, mode='r')
     # Based on https://ngff.openmicroscopy.org/latest/#bf2raw
     if 'bioformats2raw.layout' in z.attrs and z.attrs['bioformats2raw.layout']==3:
         if 'OME' in z:
@@ -173,31 +204,33 @@ def yield_images(absolute_path, relative_path):
             yield encode_image(relative_path, image_group)
 
 
-def _yield_ome_zarrs(fs, path, depth=0, maxdepth=10):
-    if depth>maxdepth: return
-    logger.trace("ls "+path)
-    children = fs.get_children(path)
+def _yield_ome_zarrs(fs, path, children, executor, depth=0, maxdepth=10):
     child_names = [c['name'] for c in children]
     if '.zattrs' in child_names:
         yield path
     elif '.zarray' in child_names:
         # This is a sign that we have gone too far
         pass
-    else:
+    elif depth < maxdepth:
         # drill down until we find a zarr
+        dirs = []
         for d in [c['path'] for c in children if c['type']=='directory']:
 
-            # TODO: temporary hack for dealing with CellMap data
             dname = os.path.basename(d)
-            if dname.endswith('.n5') or dname.endswith('align') or dname.startswith('mag') \
-                    or dname in ['raw', 'align', 'dat', 'tiles_destreak', 'mag1']:
+            if EXCLUDED_DIR_RE.match(dname):
                 continue
 
+            dirs.append(d)
+
+        # List the sibling directories concurrently, because each listing 
+        # is a round-trip on remote storage. The map preserves the walk order.
+        for d, d_children in zip(dirs, executor.map(fs.get_children, dirs)):
             logger.trace(f"Searching for zarrs in {d}")
-            for zarr_path in _yield_ome_zarrs(fs, d, depth+1):
+            for zarr_path in _yield_ome_zarrs(fs, d, d_children, executor, depth+1):
                 yield zarr_path
 
 
 def yield_ome_zarrs(fs):
-    for zarr_path in _yield_ome_zarrs(fs, ''):
-        yield zarr_path
+    with ThreadPoolExecutor(max_workers=DISCOVERY_THREADS) as executor:
+        for zarr_path in _yield_ome_zarrs(fs, '', fs.get_children(''), executor):
+            yield zarr_path
@@ -3,7 +3,7 @@ from typing import Optional
 
 from .viewers import viewers
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Channel:
     """ Information about a single channel in the image. 
         Currently loaded from OMERO metadata.
@@ -15,7 +15,7 @@ class Channel:
     contrast_limit_start: Optional[float] = None
     contrast_limit_end: Optional[float] = None
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Axis:
     """ Information about one axis of the image.
     """
@@ -25,7 +25,7 @@ class Axis:
     extent: int
     chunk: int
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Image:
     """ Information about an OME-Zarr image.
     """
@@ -52,7 +52,7 @@ class Image:
     
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class MetadataImage:
     """ Additional metadata about an OME-Zarr image that is 
         provided outside of the zarr container.
@@ -1,23 +1,59 @@
 import os
 import re
 import sys
+import hashlib
 import signal
-from functools import partial
-from urllib.parse import urlencode
+import tempfile
+from contextlib import contextmanager
+from functools import partial, lru_cache
+from urllib.parse import urlencode, quote
 
+import jinja2
+import orjson
 from loguru import logger
 from fastapi import FastAPI, Request, Response
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.concurrency import run_in_threadpool
 
-from zarrcade.filestore import Filestore
-from zarrcade.database import Database
+try:
+    from neuroglancer.viewer_state import ViewerState, CoordinateSpace, ImageLayer
+except ImportError:
+    # Neuroglancer is optional, and only needed for multichannel viewer states
+    ViewerState = None
+
+from zarrcade.filestore import Filestore, is_chunk_key, normalize_relative_path
+from zarrcade.database import Database, is_in_memory
 from zarrcade.model import Image, MetadataImage
 from zarrcade.viewers import Viewer, Neuroglancer
 from zarrcade.settings import get_settings, DataType, FilterType
 
+# Size of the blocks in which proxied files are streamed to the client
+PROXY_BLOCK_SIZE = 1 << 20
+
+# Query parameters set by the links in the pagination bar
+PAGINATION_PARAMS = {'page', 'after'}
+
+# Zarr chunks are written once, so they are cached for a long time, while 
+# metadata, thumbnails and other files may be rewritten in place, so they are 
+# only cached briefly and then revalidated using their ETag
+METADATA_CACHE_CONTROL = "public, max-age=60"
+CHUNK_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Shader for each channel of a multichannel Neuroglancer state
+CHANNEL_SHADER = ("#uicontrol vec3 hue color(default=\"{color}\")\n"
+                  "#uicontrol invlerp normalized(range=[{min_value},{max_value}])\n"
+                  "void main(){{emitRGBA(vec4(hue*normalized(),1));}}")
+
+# Single byte range in an HTTP Range header, e.g. "bytes=0-99" or "bytes=-100"
+BYTE_RANGE_RE = re.compile(r'^bytes\s*=\s*(\d*)\s*-\s*(\d*)$', re.ASCII)
+
+# Bare hex colors (e.g. "FF00FF") in OMERO channel metadata
+HEX_COLOR_RE = re.compile(r'^[\dA-Fa-f]{6}$')
+
 # Create the API
 app = FastAPI(
     title="Zarrcade OME-NGFF Gallery",
@@ -35,8 +71,55 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class PageGZipMiddleware(GZipMiddleware):
+    """ Compresses pages and JSON, but skips proxied data, which is 
+        mostly already-compressed zarr chunks.
+    """
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/data/"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+app.add_middleware(PageGZipMiddleware, minimum_size=1024)
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+# Templates only change with a redeploy, so they are not checked for changes, 
+# and their compiled bytecode is cached on disk for faster worker starts
+templates = Jinja2Templates(env=jinja2.Environment(
+    loader=jinja2.FileSystemLoader("templates"),
+    autoescape=jinja2.select_autoescape(),
+    bytecode_cache=jinja2.FileSystemBytecodeCache(),
+    auto_reload=False,
+    cache_size=-1
+))
+
+
+@contextmanager
+def startup_lock(db_url: str):
+    """ Holds an exclusive lock, shared by all the worker processes on this 
+        host which use the given database, for the duration of the context. 
+        In-memory databases are private to each process, so they need no lock.
+        Without fcntl (e.g. on Windows), this runs without a lock.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    if fcntl is None or is_in_memory(db_url):
+        yield
+        return
+
+    db_hash = hashlib.md5(db_url.encode()).hexdigest()
+    lock_path = os.path.join(tempfile.gettempdir(), f'zarrcade-startup-{db_hash}.lock')
+    with open(lock_path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 
 @app.on_event("startup")
@@ -55,44 +138,93 @@ async def startup_event():
     app.settings = get_settings()
     app.base_url = str(app.settings.base_url)
     logger.info(f"User-specified base URL is {app.base_url}")
+    app.title_column_name = app.settings.items.title_column_name
 
     # The data location can be a local path or a cloud bucket URL -- anything supported by FSSpec
     app.data_url = str(app.settings.data_url)
     logger.info(f"User-specified data URL is {app.data_url}")
-    app.fs = Filestore(app.data_url)
+    app.fs = Filestore(app.data_url, stat_cache_ttl=app.settings.stat_cache_ttl, 
+        use_obstore=app.settings.use_obstore, max_concurrent_io=app.settings.max_concurrent_io)
 
+    # URL prefixes never change, so they are built once here
+    app.neuroglancer_url_prefix = app.base_url.rstrip('/') + '/neuroglancer/'
     if app.fs.url:
         logger.info(f"Web-accessible url root is {app.fs.url}")
+        app.data_url_prefix = app.fs.url.rstrip('/') + '/'
     else:
         logger.info("Filesystem is not web-accessible and will be proxied")
+        app.data_url_prefix = app.base_url.rstrip('/') + '/data/'
+
+    if not app.fs.is_local():
+        # Set up the connection now instead of on the first request
+        app.fs.warm_up(prefetch_sizes=app.settings.prefetch_file_sizes)
 
     app.db_url = str(app.settings.db_url)
     logger.info(f"User-specified database URL is {app.db_url}")
-    app.db = Database(app.db_url)
+
+    # When running multiple workers with a shared database, only the first one 
+    # creates the tables and discovers images, and the others wait for it and 
+    # then find them in the database
+    with startup_lock(app.db_url):
+        app.db = Database(app.db_url, query_cache_ttl=app.settings.query_cache_ttl,
+                          pool_options=app.settings.db_pool.model_dump(),
+                          change_check_interval=app.settings.change_check_interval,
+                          sqlite_wal=app.settings.sqlite_wal)
+        count = app.db.get_images_count()
+        if count:
+            logger.info(f"Found {count} images in the database")
+        else:
+            app.db.persist_images(app.fs.fsroot, app.fs.yield_images)
 
     for s in app.settings.filters:
         # Infer db name for the column if the user didn't provide it
         if s.db_name is None:
             s.db_name = app.db.reverse_column_map[s.column_name]
 
-        # Get unique values from the database
-        if s.data_type == DataType.string:
-            s.values = app.db.get_unique_values(s.db_name)
-        elif s.data_type == DataType.csv:
-            s.values = app.db.get_unique_comma_delimited_values(s.db_name)
-
+    load_filter_values()
+    for s in app.settings.filters:
         logger.info(f"Configured {s.filter_type} filter for '{s.column_name}' ({len(s.values)} values)")
 
-    count = app.db.get_images_count()
-    if count:
-        logger.info(f"Found {count} images in the database")
-    else:
-        app.db.persist_images(app.fs.fsroot, app.fs.yield_images)
+    app.filter_db_names = frozenset(s.db_name for s in app.settings.filters)
+
+    # Filter values and cached viewer states are invalid once the images change
+    app.db.add_change_listener(load_filter_values)
+    app.db.add_change_listener(get_neuroglancer_state_json.cache_clear)
+
+    # Values that are the same for every request are provided to the
+    # templates once, so that each page only passes its own context
+    templates.env.globals.update({
+        "settings": app.settings,
+        "base_url": app.base_url,
+        "data_url": app.data_url,
+        "FilterType": FilterType,
+        "min": min,
+        "max": max,
+        "get_viewer_url": get_viewer_url,
+        "get_relative_path_url": get_relative_path_url,
+        "get_title": get_title,
+        "get_image_data_url": get_data_url
+    })
+
+    # Compile all the templates now, rather than on the first requests
+    for template_name in templates.env.list_templates(extensions=["html"]):
+        templates.get_template(template_name)
 
     # Restore default SIGINT handler
     signal.signal(signal.SIGINT, orig_handler)
 
 
+def load_filter_values():
+    """ Read the unique values (and their counts) for each filter from the 
+        database, so they don't need to be queried when rendering pages.
+    """
+    for s in app.settings.filters:
+        if s.data_type == DataType.string:
+            s.values = app.db.get_unique_values(s.db_name)
+        elif s.data_type == DataType.csv:
+            s.values = app.db.get_unique_comma_delimited_values(s.db_name)
+
+
 @app.on_event("shutdown")
 async def shutdown_event():
     """ Clean up database connections when the service is shut down.
@@ -101,22 +233,11 @@ async def shutdown_event():
     app.db.engine.dispose()
 
 
-def get_proxy_url(relative_path):
-    """ Returns a web-accessible URL to the file store 
-        which is proxied by this server.
-    """
-    return os.path.join(app.base_url, "data", relative_path)
-
-
 def get_data_url(image: Image):
     """ Return a web-accessible URL to the given image.
     """
-    if app.fs.url:
-        # This filestore is already web-accessible
-        return os.path.join(app.fs.url, image.relative_path)
-
-    # Proxy the data using the REST API
-    return get_proxy_url(image.relative_path)
+    # Either the filestore is web-accessible, or it's proxied by the REST API
+    return app.data_url_prefix + image.relative_path
 
 
 def get_relative_path_url(relative_path: str):
@@ -125,12 +246,8 @@ def get_relative_path_url(relative_path: str):
     if not relative_path:
         return None
 
-    if app.fs.url:
-        # This filestore is already web-accessible
-        return os.path.join(app.fs.url, relative_path)
-
-    # Proxy the data using the REST API
-    return get_proxy_url(relative_path)
+    # Either the filestore is web-accessible, or it's proxied by the REST API
+    return app.data_url_prefix + relative_path
 
 
 def get_viewer_url(image: Image, viewer: Viewer):
@@ -141,7 +258,7 @@ def get_viewer_url(image: Image, viewer: Viewer):
     if viewer==Neuroglancer:
         if image.axes_order == 'tczyx':
             # Generate a multichannel config on-the-fly
-            url = os.path.join(app.base_url, "neuroglancer", image.relative_path)
+            url = app.neuroglancer_url_prefix + image.relative_path
         else:
             # Prepend format for Neuroglancer to understand
             url = 'zarr://' + url
@@ -152,51 +269,64 @@ def get_viewer_url(image: Image, viewer: Viewer):
 def get_title(metaimage: MetadataImage):
     """ Returns the title to display underneath the given image.
     """
-    settings = get_settings()
-    col_name = settings.items.title_column_name
-    if col_name:
-        return metaimage.metadata[col_name]
+    if app.title_column_name:
+        return metaimage.metadata[app.title_column_name]
 
     return metaimage.image.relative_path
 
 
-def get_query_string(query_params, **new_params):
-    """ Takes the current query params, optionally overrides some parameters 
-        and return a formatted query string.
+def get_query_string(base_query_string: str, **new_params):
+    """ Appends the given parameters to an already formatted query string,
+        which must not contain any of them, and returns the result.
+    """
+    if not base_query_string:
+        return urlencode(new_params)
+    return base_query_string + '&' + urlencode(new_params)
+
+
+def get_gallery_item(metaimage: MetadataImage):
+    """ Returns the URLs and title needed to render the given image in the 
+        gallery, so that the template does not derive them for every row.
     """
-    return urlencode(dict(query_params) | new_params)
+    image = metaimage.image
+    return {
+        'metaimage': metaimage,
+        'image': image,
+        'thumbnail_url': get_relative_path_url(metaimage.thumbnail_path),
+        'data_url': get_data_url(image),
+        'viewer_urls': [(viewer, get_viewer_url(image, viewer))
+                        for viewer in image.get_compatible_viewers()],
+        'title': get_title(metaimage)
+    }
 
 
 
 @app.get("/", response_class=HTMLResponse, include_in_schema=False)
-async def index(request: Request, search_string: str = '', page: int = 1, page_size: int=50):
+async def index(request: Request, search_string: str = '', page: int = 1, page_size: int=50, 
+        after: int = None):
 
     # Did the user select any filters?
-    filter_params = {}
-    for s in app.settings.filters:
-        param_value = request.query_params.get(s.db_name)
-        if param_value:
-            filter_params[s.db_name] = param_value
+    filter_params = {k: v for k, v in request.query_params.items() 
+                     if v and k in app.filter_db_names}
+
 
+    # Query in a worker thread so that the event loop is not blocked
+    result = await run_in_threadpool(app.db.find_metaimages, 
+        search_string, filter_params, page, page_size, after)
 
-    result = app.db.find_metaimages(search_string, filter_params, page, page_size)
+    # Encode the current query once, without the pagination parameters 
+    # which each page link provides. The cursor is only kept by the next link.
+    base_query_string = urlencode({k: v for k, v in request.query_params.items() 
+                                   if k not in PAGINATION_PARAMS})
 
     return templates.TemplateResponse(
         request=request, name="index.html", context={
-            "settings": app.settings,
-            "base_url": app.base_url,
             "metaimages": result['images'],
-            "get_viewer_url": get_viewer_url,
-            "get_relative_path_url": get_relative_path_url,
-            "get_image_data_url": get_data_url,
-            "get_title": get_title,
-            "get_query_string": partial(get_query_string, request.query_params),
+            "items": [get_gallery_item(m) for m in result['images']],
+            "get_query_string": partial(get_query_string, base_query_string),
             "search_string": search_string,
             "pagination": result['pagination'],
-            "filter_params": filter_params,
-            "FilterType": FilterType,
-            "min": min,
-            "max": max
+            "filter_params": filter_params
         }
     )
 
@@ -204,62 +334,159 @@ async def index(request: Request, search_string: str = '', page: int = 1, page_s
 @app.get("/details/{image_id:path}", response_class=HTMLResponse, include_in_schema=False)
 async def details(request: Request, image_id: str):
 
-    metaimage = app.db.get_metaimage(image_id)
+    metaimage = await run_in_threadpool(app.db.get_metaimage, image_id)
     if not metaimage:
         return Response(status_code=404)
 
     return templates.TemplateResponse(
         request=request, name="details.html", context={
-            "settings": app.settings,
-            "data_url": app.data_url,
-            "metaimage": metaimage,
-            "get_viewer_url": get_viewer_url,
-            "get_relative_path_url": get_relative_path_url,
-            "get_title": get_title,
-            "get_image_data_url": get_data_url
+            "metaimage": metaimage
         }
     )
 
 
+def get_byte_range(range_header: str, size: int):
+    """ Parses an HTTP Range header for a file of the given size, and returns 
+        the requested (start, end) byte offsets, where the end is exclusive. 
+        Returns None if there is no header, or if it's not a single valid 
+        byte range, in which case the whole file should be sent. Ranges which 
+        cannot be satisfied are returned with start >= end.
+    """
+    if not range_header:
+        return None
+    match = BYTE_RANGE_RE.match(range_header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = size
+        if last:
+            if int(last) < start:
+                # Invalid range, which must be ignored
+                return None
+            end = int(last) + 1
+    elif last:
+        # Suffix range, i.e. the last N bytes
+        start = max(size - int(last), 0)
+        end = size
+    else:
+        return None
+    return start, min(end, size)
+
+
+def get_data_cache_headers(relative_path: str, etag: str):
+    """ Returns the caching headers for the given proxied file.
+    """
+    headers = {}
+    if is_chunk_key(relative_path):
+        headers["Cache-Control"] = CHUNK_CACHE_CONTROL
+    else:
+        headers["Cache-Control"] = METADATA_CACHE_CONTROL
+    if etag:
+        headers["ETag"] = etag
+    return headers
+
+
 @app.head("/data/{relative_path:path}")
-async def data_proxy_head(relative_path: str):
+async def data_proxy_head(request: Request, relative_path: str):
+    relative_path = normalize_relative_path(relative_path)
+    if relative_path is None:
+        return Response(status_code=404)
     try:
-        size = app.fs.get_size(relative_path)
-        headers = {}
+        size, etag = await app.fs.get_stat_async(relative_path)
+        headers = get_data_cache_headers(relative_path, etag)
+        if etag and request.headers.get("If-None-Match") == etag:
+            return Response(status_code=304, headers=headers)
         headers["Content-Type"] = "binary/octet-stream"
         headers["Content-Length"] = str(size)
+        headers["Accept-Ranges"] = "bytes"
         return Response(status_code=200, headers=headers)
     except FileNotFoundError:
         return Response(status_code=404)
 
 
 @app.get("/data/{relative_path:path}")
-async def data_proxy_get(relative_path: str):
+async def data_proxy_get(request: Request, relative_path: str):
+    # Never serve anything outside of the filestore
+    relative_path = normalize_relative_path(relative_path)
+    if relative_path is None:
+        return Response(status_code=404)
+
+    if app.settings.accel_redirect_prefix:
+        # Let the front-end web server send the file itself. It generates
+        # the ETag, and keeps the other caching headers given here.
+        headers = get_data_cache_headers(relative_path, None)
+        headers["X-Accel-Redirect"] = app.settings.accel_redirect_prefix + quote(relative_path)
+        return Response(media_type="binary/octet-stream", headers=headers)
+
     try:
-        with app.fs.open(relative_path) as f:
-            data = f.read()
-            headers = {}
-            headers["Content-Type"] = "binary/octet-stream"
-            return Response(status_code=200, headers=headers, content=data)
+        size, etag = await app.fs.get_stat_async(relative_path)
     except FileNotFoundError:
         return Response(status_code=404)
 
+    headers = get_data_cache_headers(relative_path, etag)
+    if etag and request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    if app.fs.is_local():
+        local_path = app.fs.get_local_path(relative_path)
+        if local_path is None:
+            return Response(status_code=404)
+        # Serve local files directly, without going through fsspec. 
+        # This also takes care of any Range request.
+        return FileResponse(local_path, media_type="binary/octet-stream", headers=headers)
+
+    headers["Accept-Ranges"] = "bytes"
+    byte_range = None
+    if_range = request.headers.get("If-Range")
+    if not if_range or if_range == etag:
+        byte_range = get_byte_range(request.headers.get("Range"), size)
+
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(app.fs.iter_blocks(relative_path, size, PROXY_BLOCK_SIZE),
+            media_type="binary/octet-stream", headers=headers)
 
-@app.get("/neuroglancer/{image_id:path}", response_class=JSONResponse, include_in_schema=False)
-async def neuroglancer_state(image_id: str):
+    start, end = byte_range
+    if start >= end:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status_code=416, headers=headers)
 
-    from neuroglancer.viewer_state import ViewerState, CoordinateSpace, ImageLayer
+    # Send only the requested part, e.g. a partial chunk read by a viewer
+    headers["Content-Range"] = f"bytes {start}-{end-1}/{size}"
+    headers["Content-Length"] = str(end - start)
+    return StreamingResponse(app.fs.iter_blocks(relative_path, size, PROXY_BLOCK_SIZE, start, end),
+        status_code=206, media_type="binary/octet-stream", headers=headers)
+
+
+class StateUnavailableError(Exception):
+    """ Raised when a viewer state cannot be generated for an image.
+    """
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@lru_cache(maxsize=4096)
+def get_neuroglancer_state_json(image_id: str) -> bytes:
+    """ Builds the multichannel Neuroglancer state for the given image and 
+        returns it serialized as JSON. The result is cached until the 
+        images in the database change.
+    """
+    if ViewerState is None:
+        raise StateUnavailableError(501, "Neuroglancer is not installed")
 
     metaimage = app.db.get_metaimage(image_id)
     if not metaimage:
-        return Response(status_code=404)
+        raise StateUnavailableError(404, f"Image not found: {image_id}")
 
     image = metaimage.image
     url = get_data_url(image)
 
     if image.axes_order != 'tczyx':
         logger.error("Neuroglancer states can currently only be generated for TCZYX images")
-        return Response(status_code=400)
+        raise StateUnavailableError(400, f"Unsupported axes order: {image.axes_order}")
 
     state = ViewerState()
     # TODO: dataclasses don't dsupport nested deserialization which makes this strange. Should switch to Pydantic.
@@ -281,26 +508,28 @@ async def neuroglancer_state(image_id: str):
     state.crossSectionScale = 4.5
     state.projectionScale = 2048
 
+    # Every channel layer is positioned along the same local channel axis
+    channel_dimensions = CoordinateSpace(names=["c'"], scales=[1], units=[''])
+
     for i, channel in enumerate(image.channels):
 
         min_value = channel['pixel_intensity_min'] or 0
         max_value = channel['pixel_intensity_max'] or 4096
 
         color = channel['color']
-        if re.match(r'^([\dA-F]){6}$', color):
+        if HEX_COLOR_RE.match(color):
             # bare hex color, add leading hash for rendering
             color = '#' + color
 
         layer = ImageLayer(
                 source='zarr://'+url,
-                layerDimensions=CoordinateSpace(names=["c'"], scales=[1], units=['']),
+                layerDimensions=channel_dimensions,
                 localPosition=[i],
                 tab='rendering',
                 opacity=1,
                 blend='additive',
-                shader=(f"#uicontrol vec3 hue color(default=\"{color}\")\n"
-                        f"#uicontrol invlerp normalized(range=[{min_value},{max_value}])\n"
-                        f"void main(){{emitRGBA(vec4(hue*normalized(),1));}}")
+                shader=CHANNEL_SHADER.format(color=color, 
+                    min_value=min_value, max_value=max_value)
             )
 
         start = channel['contrast_limit_start']
@@ -319,4 +548,31 @@ async def neuroglancer_state(image_id: str):
         state.layers.append(name=channel['name'], layer=layer)
 
     state.layout = '4panel'
-    return JSONResponse(state.to_json())
+    return orjson.dumps(state.to_json(), option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def get_current_neuroglancer_state_json(image_id: str) -> bytes:
+    """ Returns the Neuroglancer state for the given image, after discarding 
+        any cached states which were invalidated by other processes.
+    """
+    app.db.check_for_changes()
+    return get_neuroglancer_state_json(image_id)
+
+
+@app.get("/neuroglancer/{image_id:path}", response_class=JSONResponse, include_in_schema=False)
+async def neuroglancer_state(request: Request, image_id: str):
+    try:
+        # Building an uncached state queries the database, so it's done in a 
+        # worker thread to avoid blocking the event loop
+        content = await run_in_threadpool(get_current_neuroglancer_state_json, image_id)
+    except StateUnavailableError as e:
+        return Response(status_code=e.status_code)
+
+    headers = {}
+    headers["Cache-Control"] = METADATA_CACHE_CONTROL
+    headers["ETag"] = '"' + hashlib.md5(content).hexdigest() + '"'
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=content, media_type="application/json", headers=headers)
+
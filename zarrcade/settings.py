@@ -1,6 +1,6 @@
 from pathlib import Path
 from enum import Enum
-from typing import Union, List, Set
+from typing import Optional, Union, List, Set
 from functools import cache
 
 from pydantic import AnyUrl, HttpUrl, BaseModel, field_validator
@@ -36,6 +36,15 @@ class Details(BaseModel):
     hide_columns: Set[str] = set()
 
 
+class DatabasePool(BaseModel):
+    # Connection pool options passed to SQLAlchemy's create_engine
+    pool_size: int = 20
+    max_overflow: int = 40
+    pool_timeout: int = 30
+    pool_pre_ping: bool = True
+    pool_recycle: int = 3600
+
+
 class Settings(BaseSettings):
     """ Zarrcade settings can be read from a settings.yaml file, 
         or from the environment, with environment variables prepended 
@@ -47,10 +56,30 @@ class Settings(BaseSettings):
     data_url: Union[AnyUrl | Path] = None
     title: str = "Zarrcade"
     db_url: AnyUrl = 'sqlite:///:memory:'
+    db_pool: DatabasePool = DatabasePool()
+    # Use write-ahead logging for SQLite databases. Only enable this if the 
+    # database file is on a local filesystem, since it doesn't work over NFS.
+    sqlite_wal: bool = False
     filters: List[Filter] = []
     items: Items = Items()
     details: Details = Details()
     debug_sql: bool = False
+    # Seconds to cache the sizes of proxied zarr chunks (0 disables the cache)
+    stat_cache_ttl: int = 28800
+    # Cache the sizes of all chunks in remote filestores during startup
+    prefetch_file_sizes: bool = False
+    # Serve data from S3 with obstore instead of s3fs, if it's installed
+    use_obstore: bool = False
+    # Maximum concurrent filestore operations per worker (0 for no limit)
+    max_concurrent_io: int = 64
+    # Path prefix under which a front-end web server (e.g. nginx) serves the
+    # data directly, using X-Accel-Redirect instead of proxying it here
+    accel_redirect_prefix: Optional[str] = None
+    # Seconds to cache search results (0 disables the cache)
+    query_cache_ttl: int = 60
+    # Seconds between checks for database changes made by other processes 
+    # (e.g. bin/init_db.py), which refresh the filters and caches (0 disables)
+    change_check_interval: int = 30
 
     model_config = SettingsConfigDict(
         yaml_file="settings.yaml",
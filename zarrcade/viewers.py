@@ -6,8 +6,12 @@ class Viewer:
     icon: str
     _url_template: str
 
+    def __post_init__(self):
+        # Split the template once, so that building a URL is a concatenation
+        self._url_prefix, _, self._url_suffix = self._url_template.partition('{URL}')
+
     def get_viewer_url(self, url):
-        return self._url_template.replace('{URL}', url)
+        return self._url_prefix + url + self._url_suffix
 
 
 Neuroglancer = Viewer(